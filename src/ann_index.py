@@ -0,0 +1,227 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import os
+import argparse
+import numpy as np
+
+def squared_distances(x, centroids, centroid_norms = None):
+    '''
+    Squared L2 distances between the rows of x and the centroids, as a (len(x), len(centroids)) matrix.
+    '''
+    if centroid_norms is None:
+        centroid_norms = (centroids ** 2).sum(axis=1)
+    return (x ** 2).sum(axis=1)[:, None] - 2.0 * np.dot(x, centroids.T) + centroid_norms[None, :]
+
+def kmeans(x, k, iterations = 20, seed = 0, chunk_size = 65536):
+    '''
+    Lloyd's k-means initialized from random samples, the assignment step runs in chunks to bound memory.
+    '''
+    rng       = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign(x, centroids, chunk_size)
+        counts     = np.bincount(assignment, minlength=k)
+        sums       = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+
+        # empty clusters are moved to random samples.
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty]  = x[rng.choice(len(x), empty.sum(), replace=False)]
+    return centroids
+
+def assign(x, centroids, chunk_size = 65536):
+    '''
+    Index of the nearest centroid of each row of x.
+    '''
+    norms      = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        assignment[start:start+chunk_size] = np.argmin(squared_distances(x[start:start+chunk_size], centroids, norms), axis=1)
+    return assignment
+
+class IVFPQIndex(object):
+    '''
+    Approximate nearest neighbor index with an inverted file and product quantization
+    (https://hal.inria.fr/inria-00514462). Vectors are assigned to the nearest of list_count coarse centroids,
+    and their residual to it is encoded with one byte for each of the subspace_count subspaces. A query only
+    scans the vectors of its nearest "probe" lists, with distances computed from per-query lookup tables.
+    '''
+    def __init__(self, list_count = 1024, subspace_count = 64):
+        self.list_count     = list_count
+        self.subspace_count = subspace_count
+        self.coarse         = None  # (list_count, dim) coarse centroids.
+        self.codebooks      = None  # (subspace_count, 256, dim / subspace_count) residual centroids.
+        self.codes          = None  # (count, subspace_count) uint8 codes sorted by list.
+        self.ids            = None  # row of each code in the embedding matrix.
+        self.offsets        = None  # codes of list i are codes[offsets[i]:offsets[i+1]].
+
+    def train(self, embeddings, train_size = 200000, seed = 0):
+        '''
+        Learn the coarse centroids and the product quantizer from a random sample of the embeddings.
+        '''
+        rng    = np.random.RandomState(seed)
+        sample = np.sort(rng.choice(len(embeddings), min(train_size, len(embeddings)), replace=False))
+        x      = np.asarray(embeddings[sample], dtype=np.float32)
+        if x.shape[1] % self.subspace_count != 0:
+            raise ValueError("The dimension {} is not a multiple of {} subspaces.".format(x.shape[1], self.subspace_count))
+
+        self.coarse = kmeans(x, self.list_count, seed=seed)
+        residuals   = x - self.coarse[assign(x, self.coarse)]
+        subspaces   = np.split(residuals, self.subspace_count, axis=1)
+        self.codebooks = np.stack([kmeans(subspace, 256, seed=seed) for subspace in subspaces])
+
+    def add(self, embeddings, chunk_size = 65536):
+        '''
+        Encode all the embeddings, reading them in chunks so that a memory-mapped matrix never has to fit in memory.
+        '''
+        count  = len(embeddings)
+        lists  = np.empty(count, dtype=np.int32)
+        codes  = np.empty((count, self.subspace_count), dtype=np.uint8)
+        for start in range(0, count, chunk_size):
+            x = np.asarray(embeddings[start:start+chunk_size], dtype=np.float32)
+            lists[start:start+len(x)] = assign(x, self.coarse)
+            codes[start:start+len(x)] = self._encode(x - self.coarse[lists[start:start+len(x)]])
+
+        order        = np.argsort(lists, kind='stable')
+        self.codes   = codes[order]
+        self.ids     = order.astype(np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(lists, minlength=self.list_count)))).astype(np.int64)
+
+    def search(self, queries, k = 10, probe = 16, batch_size = 256):
+        '''
+        Return the (distances, ids) of the approximate k nearest neighbors of each query, ids are -1 when
+        fewer than k vectors were scanned. Queries are processed in batches, and each inverted list probed
+        by a batch is read once and scanned for all the queries of the batch that probe it.
+        '''
+        queries   = np.asarray(queries, dtype=np.float32)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids       = np.full((len(queries), k), -1, dtype=np.int64)
+        for start in range(0, len(queries), batch_size):
+            batch  = queries[start:start+batch_size]
+            probes = np.argsort(squared_distances(batch, self.coarse), axis=1)[:, :probe]
+            best_distances = distances[start:start+len(batch)]
+            best_ids       = ids[start:start+len(batch)]
+            for list_id in np.unique(probes):
+                begin, end = self.offsets[list_id], self.offsets[list_id + 1]
+                if begin == end:
+                    continue
+                rows   = np.flatnonzero((probes == list_id).any(axis=1))
+                tables = self._distance_tables(batch[rows] - self.coarse[list_id])
+                codes  = np.asarray(self.codes[begin:end])
+                list_distances = np.zeros((len(rows), end - begin), dtype=np.float32)
+                for subspace in range(self.subspace_count):
+                    list_distances += tables[:, subspace, codes[:, subspace]]
+
+                # merge the list with the current best k of each query.
+                merged_distances = np.concatenate((best_distances[rows], list_distances), axis=1)
+                merged_ids       = np.concatenate((best_ids[rows], np.broadcast_to(self.ids[begin:end], list_distances.shape)), axis=1)
+                top = np.argsort(merged_distances, axis=1)[:, :k]
+                best_distances[rows] = np.take_along_axis(merged_distances, top, axis=1)
+                best_ids[rows]       = np.take_along_axis(merged_ids, top, axis=1)
+        return distances, ids
+
+    def save(self, index_folder):
+        '''
+        Save the index as .npy files, the codes can later be memory-mapped.
+        '''
+        if not os.path.exists(index_folder):
+            os.makedirs(index_folder)
+        for name in ['coarse', 'codebooks', 'codes', 'ids', 'offsets']:
+            np.save(os.path.join(index_folder, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, index_folder, mmap_mode = 'r'):
+        '''
+        Load an index saved by "save", memory-mapping the codes and ids.
+        '''
+        index = cls()
+        for name in ['coarse', 'codebooks', 'offsets']:
+            setattr(index, name, np.load(os.path.join(index_folder, name + '.npy')))
+        for name in ['codes', 'ids']:
+            setattr(index, name, np.load(os.path.join(index_folder, name + '.npy'), mmap_mode=mmap_mode))
+        index.list_count     = len(index.coarse)
+        index.subspace_count = len(index.codebooks)
+        return index
+
+    def _encode(self, residuals):
+        subspaces = np.split(residuals, self.subspace_count, axis=1)
+        return np.stack([assign(subspace, codebook) for subspace, codebook in zip(subspaces, self.codebooks)], axis=1)
+
+    def _distance_tables(self, residuals):
+        # (query, subspace_count, 256) squared distances between each residual subvector and each centroid.
+        subvectors = residuals.reshape(len(residuals), self.subspace_count, 1, -1)
+        return ((subvectors - self.codebooks[None, :, :, :]) ** 2).sum(axis=3)
+
+def main(command, embeddings_path, index_folder, list_count, subspace_count, rows, k, probe):
+    '''
+    Build an index over an embedding matrix written by extract_features.py, or query it with some of its rows
+    and print the nearest images.
+    '''
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    if command == 'build':
+        index = IVFPQIndex(list_count, subspace_count)
+        print("Training on {} embeddings of dimension {}.".format(len(embeddings), embeddings.shape[1]))
+        index.train(embeddings)
+        index.add(embeddings)
+        index.save(index_folder)
+        print("Saved the index to {}.".format(index_folder))
+    elif command == 'query':
+        names_path = os.path.splitext(embeddings_path)[0] + '.txt'
+        names      = None
+        if os.path.exists(names_path):
+            with open(names_path) as names_file:
+                names = [line.strip() for line in names_file]
+
+        index = IVFPQIndex.load(index_folder)
+        distances, ids = index.search(np.asarray(embeddings[rows], dtype=np.float32), k, probe)
+        for row, row_distances, row_ids in zip(rows, distances, ids):
+            print(names[row] if names else row)
+            for distance, neighbor in zip(row_distances, row_ids):
+                if neighbor >= 0:
+                    print("\t{}\t{:.3f}".format(names[neighbor] if names else neighbor, distance))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command",
+                        choices = ['build', 'query'],
+                        help = "Build the index, or query it with rows of the embedding matrix.")
+    parser.add_argument("-e",
+                        "--embeddings_path",
+                        type = str,
+                        help = "Path of the .npy embedding matrix written by extract_features.py.",
+                        required = True)
+    parser.add_argument("-i",
+                        "--index_folder",
+                        type = str,
+                        help = "Folder of the index files.",
+                        required = True)
+    parser.add_argument("--list_count",
+                        type = int,
+                        default = 1024,
+                        help = "Number of inverted lists, about 4 x sqrt(number of embeddings) works well.")
+    parser.add_argument("--subspace_count",
+                        type = int,
+                        default = 64,
+                        help = "Number of product quantization subspaces, i.e. bytes per embedding.")
+    parser.add_argument("-r",
+                        "--rows",
+                        type = int,
+                        nargs = '+',
+                        default = [0],
+                        help = "Rows of the embedding matrix to query.")
+    parser.add_argument("-k",
+                        type = int,
+                        default = 10,
+                        help = "Number of neighbors returned per query.")
+    parser.add_argument("-p",
+                        "--probe",
+                        type = int,
+                        default = 16,
+                        help = "Number of inverted lists scanned per query.")
+
+    args = parser.parse_args()
+    main(args.command, args.embeddings_path, args.index_folder, args.list_count, args.subspace_count, args.rows, args.k, args.probe)
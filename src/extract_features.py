@@ -0,0 +1,113 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import os
+import csv
+import argparse
+import numpy as np
+
+from PIL import Image
+from rect_util import Rect
+import img_util as imgu
+from lazy_import import LazyModule
+
+ct = LazyModule('cntk')
+
+def list_images(base_folder, sub_folders, label_file_name):
+    '''
+    Return the (folder, image name, face rectangle) of every image listed in the label files, including the
+    ones the reader drops as unknown or not a face.
+    '''
+    images = []
+    for folder_name in sub_folders:
+        with open(os.path.join(base_folder, folder_name, label_file_name)) as csvfile:
+            for row in csv.reader(csvfile):
+                box = list(map(int, row[1][1:-1].split(',')))
+                images.append((folder_name, row[0], Rect(box)))
+    return images
+
+def main(base_folder, sub_folders, model_path, layer_name, output_path, minibatch_size):
+    '''
+    Write the activations of a layer of a trained model for every image of the given folders into a float16
+    matrix, saved as a memory-mapped .npy file with one row per image. The image of each row is listed in a
+    text file next to it.
+
+    Args:
+        base_folder(str): The base folder that contains the image folders.
+        sub_folders(list): The folders to extract, e.g. 'FER2013Train'.
+        model_path(str): The model saved by train.py.
+        layer_name(str): The layer to extract, 'fc6' is the penultimate layer of VGG13.
+        output_path(str): Path of the .npy embedding matrix.
+        minibatch_size(int): Number of images evaluated at once.
+    '''
+    model     = ct.load_model(model_path)
+    layer     = model.find_by_name(layer_name)
+    if layer is None:
+        raise ValueError("The model has no layer named {}.".format(layer_name))
+    features  = ct.combine([layer.owner])
+    input_var = features.arguments[0]
+
+    _, height, width = input_var.shape
+    A, A_pinv = imgu.compute_norm_mat(width, height)
+
+    images = list_images(base_folder, sub_folders, "label.csv")
+    print("Extracting {} from {} images.".format(layer_name, len(images)))
+
+    embeddings = None
+    for start in range(0, len(images), minibatch_size):
+        batch  = images[start:start+minibatch_size]
+        inputs = np.empty(shape=(len(batch), 1, height, width), dtype=np.float32)
+        for idx, (folder_name, image_name, face_rc) in enumerate(batch):
+            image_data = Image.open(os.path.join(base_folder, folder_name, image_name)).convert('L')
+            cropped    = imgu.distort_img(np.asarray(image_data), face_rc, width, height, 0.0, 1.0, 0.0, 0.0, False, imgu.no_distortion)
+            inputs[idx] = imgu.preproc_img(cropped, A=A, A_pinv=A_pinv)
+
+        outputs = np.asarray(features.eval({input_var : inputs})).reshape(len(batch), -1)
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float16, shape=(len(images), outputs.shape[1]))
+        embeddings[start:start+len(batch)] = outputs
+
+    if embeddings is not None:
+        embeddings.flush()
+        with open(os.path.splitext(output_path)[0] + '.txt', 'w') as names_file:
+            names_file.writelines("{}/{}\n".format(folder_name, image_name) for folder_name, image_name, _ in images)
+        print("Wrote a {} embedding matrix to {}.".format(embeddings.shape, output_path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d",
+                        "--base_folder",
+                        type = str,
+                        help = "Base folder containing the training, validation and testing folder.",
+                        required = True)
+    parser.add_argument("-s",
+                        "--sub_folders",
+                        type = str,
+                        nargs = '+',
+                        default = ['FER2013Train'],
+                        help = "Folders whose images are extracted.")
+    parser.add_argument("-m",
+                        "--model_path",
+                        type = str,
+                        help = "Path of the model saved by train.py.",
+                        required = True)
+    parser.add_argument("-l",
+                        "--layer_name",
+                        type = str,
+                        default = 'fc6',
+                        help = "Name of the layer whose activations are extracted.")
+    parser.add_argument("-o",
+                        "--output_path",
+                        type = str,
+                        default = 'embeddings.npy',
+                        help = "Path of the .npy float16 embedding matrix.")
+    parser.add_argument("-b",
+                        "--minibatch_size",
+                        type = int,
+                        default = 256,
+                        help = "Number of images evaluated at once.")
+
+    args = parser.parse_args()
+    main(args.base_folder, args.sub_folders, args.model_path, args.layer_name, args.output_path, args.minibatch_size)
@@ -6,6 +6,7 @@
 import sys
 import os
 import csv
+import math
 import numpy as np
 import logging
 import random as rnd
@@ -14,7 +15,20 @@ from collections import namedtuple
 from PIL import Image
 from rect_util import Rect
 import img_util as imgu
-import matplotlib.pyplot as plt
+
+# Random streams of the reader, each stream is further split per epoch and per sample.
+AUGMENTATION_STREAM = 0
+FIXED_CROP_STREAM   = 1
+SHUFFLE_STREAM      = 2
+MINING_STREAM       = 3
+
+def sample_rng(seed, stream, epoch = 0, index = 0):
+    '''
+    Return a counter-based (Philox) random generator for the given seed, stream, epoch and sample index.
+    The draws only depend on these values, so a sample gets the same augmentation whatever the number
+    of workers or the order in which the minibatches are built.
+    '''
+    return np.random.Generator(np.random.Philox(key=seed, counter=[0, index, epoch, stream]))
 
 def display_summary(train_data_reader, val_data_reader, test_data_reader):
     '''
@@ -34,13 +48,14 @@ class FERPlusParameters():
     '''
     FER+ reader parameters
     '''
-    def __init__(self, target_size, width, height, training_mode = "majority", determinisitc = False, shuffle = True):
+    def __init__(self, target_size, width, height, training_mode = "majority", determinisitc = False, shuffle = True, seed = None):
         self.target_size   = target_size
         self.width         = width
         self.height        = height
         self.training_mode = training_mode
         self.determinisitc = determinisitc
         self.shuffle       = shuffle
+        self.seed          = seed if seed is not None else np.random.SeedSequence().entropy % (2**128)
                      
 class FERPlusReader(object):
     '''
@@ -48,29 +63,34 @@ class FERPlusReader(object):
         https://arxiv.org/abs/1608.01041
     '''
     @classmethod
-    def create(cls, base_folder, sub_folders, label_file_name, parameters):
+    def create(cls, base_folder, sub_folders, label_file_name, parameters, exclude_file_name = None):
         '''
         Factory function that create an instance of FERPlusReader and load the data form disk.
         '''
-        reader = cls(base_folder, sub_folders, label_file_name, parameters)
+        reader = cls(base_folder, sub_folders, label_file_name, parameters, exclude_file_name)
         reader.load_folders(parameters.training_mode)
         return reader
         
-    def __init__(self, base_folder, sub_folders, label_file_name, parameters):
+    def __init__(self, base_folder, sub_folders, label_file_name, parameters, exclude_file_name = None):
         '''
         Each sub_folder contains the image files and a csv file for the corresponding label. The read iterate through
-        all the sub_folders and aggregate all the images and their corresponding labels.        
+        all the sub_folders and aggregate all the images and their corresponding labels. Images listed in the
+        optional exclude file of a sub_folder, such as the duplicates found by find_duplicates.py, are skipped.
         '''
-        self.base_folder     = base_folder
-        self.sub_folders     = sub_folders
-        self.label_file_name = label_file_name
+        self.base_folder       = base_folder
+        self.sub_folders       = sub_folders
+        self.label_file_name   = label_file_name
+        self.exclude_file_name = exclude_file_name
         self.emotion_count   = parameters.target_size
         self.width           = parameters.width
         self.height          = parameters.height
         self.shuffle         = parameters.shuffle
         self.training_mode   = parameters.training_mode
+        self.seed            = parameters.seed
+        self.epoch           = 0
 
         # data augmentation parameters.determinisitc
+        self.determinisitc = parameters.determinisitc
         if parameters.determinisitc:
             self.max_shift = 0.0
             self.max_scale = 1.0
@@ -85,17 +105,33 @@ class FERPlusReader(object):
             self.do_flip = True
         
         self.data              = None
+        self.labels            = None
         self.per_emotion_count = None
         self.batch_start       = 0
         self.indices           = 0
+        self.batch_indices     = None
+        self.crops             = None
+        self.crop_count        = 0
+        self.batch_crops       = None
 
-        self.A, self.A_pinv = imgu.compute_norm_mat(self.width, self.height)
+        self.norm_mats = {}
+        self.set_size(self.width, self.height)
+
+    def set_size(self, width, height):
+        '''
+        Change the size of the generated images, the normalization matrices are cached per size.
+        '''
+        if (width, height) not in self.norm_mats:
+            self.norm_mats[(width, height)] = imgu.compute_norm_mat(width, height)
+        self.width          = width
+        self.height         = height
+        self.A, self.A_pinv = self.norm_mats[(width, height)]
         
     def has_more(self):
         '''
         Return True if there is more min-batches.
         '''
-        if self.batch_start < len(self.data):
+        if self.batch_start < len(self.indices):
             return True
         return False
 
@@ -105,6 +141,12 @@ class FERPlusReader(object):
         '''
         self.batch_start = 0
 
+    def set_epoch(self, epoch):
+        '''
+        Set the epoch used to derive the random stream of each sample.
+        '''
+        self.epoch = epoch
+
     def size(self):
         '''
         Return the number of images read by this reader.
@@ -115,48 +157,90 @@ class FERPlusReader(object):
         '''
         Return the next mini-batch, we do data augmentation during constructing each mini-batch.
         '''
-        data_size = len(self.data)
+        data_size = len(self.indices)
         batch_end = min(self.batch_start + batch_size, data_size)
         current_batch_size = batch_end - self.batch_start
         if current_batch_size < 0:
             raise Exception('Reach the end of the training data.')
         
-        inputs = np.empty(shape=(current_batch_size, 1, self.width, self.height), dtype=np.float32)
-        targets = np.empty(shape=(current_batch_size, self.emotion_count), dtype=np.float32)
-        for idx in range(self.batch_start, batch_end):
-            index = self.indices[idx]
-            distorted_image = imgu.distort_img(self.data[index][1], 
-                                               self.data[index][3], 
+        self.batch_indices = self.indices[self.batch_start:batch_end]
+        rngs = [sample_rng(self.seed, AUGMENTATION_STREAM, self.epoch, index) for index in self.batch_indices]
+        if self.crops is not None:
+            self.batch_crops = np.array([rng.integers(self.crop_count) for rng in rngs])
+
+        inputs   = self.images(self.batch_indices, self.batch_crops, rngs)
+        uniforms = np.array([rng.random() for rng in rngs]) if self.training_mode == 'probability' else None
+        targets  = self.labels.gather(self.batch_indices, uniforms)
+
+        self.batch_start += current_batch_size
+        return inputs, targets, current_batch_size
+        
+    def images(self, indices, crops = None, rngs = None):
+        '''
+        Build the network input for the given samples. When crops is given, sample indices[i] uses its
+        fixed crop crops[i] (see "set_fixed_crops"), otherwise a random distortion is drawn from rngs[i],
+        or from the sample stream of the current epoch when rngs is not given.
+        '''
+        inputs = np.empty(shape=(len(indices), 1, self.width, self.height), dtype=np.float32)
+        for idx, index in enumerate(indices):
+            if crops is not None:
+                distortion = self.crops[index][crops[idx]]
+            elif self.determinisitc:
+                distortion = imgu.no_distortion
+            else:
+                rng        = rngs[idx] if rngs is not None else sample_rng(self.seed, AUGMENTATION_STREAM, self.epoch, index)
+                distortion = imgu.sample_distortion(rng)
+            image, face_rc  = self._image(index)
+            distorted_image = imgu.distort_img(image, 
+                                               face_rc, 
                                                self.width, 
                                                self.height, 
                                                self.max_shift, 
                                                self.max_scale, 
                                                self.max_angle, 
                                                self.max_skew, 
-                                               self.do_flip)
-            final_image = imgu.preproc_img(distorted_image, A=self.A, A_pinv=self.A_pinv)
+                                               self.do_flip,
+                                               distortion)
+            inputs[idx] = imgu.preproc_img(distorted_image, A=self.A, A_pinv=self.A_pinv)
+        return inputs
 
-            inputs[idx-self.batch_start]    = final_image
-            targets[idx-self.batch_start,:] = self._process_target(self.data[index][2])
+    def _image(self, index):
+        '''
+        Return the image and the face rectangle of a sample.
+        '''
+        return self.data[index][1], self.data[index][2]
+
+    def set_fixed_crops(self, crop_count):
+        '''
+        Draw crop_count distortions once per image, from then on each minibatch sample uses one of the
+        fixed crops of its image and "batch_crops" records which one. This allows caching per crop results
+        such as the soft outputs of a teacher model.
+        '''
+        self.crop_count = crop_count
+        self.crops      = [[imgu.sample_distortion(sample_rng(self.seed, FIXED_CROP_STREAM, crop, index)) for crop in range(crop_count)] 
+                           for index in range(len(self.data))]
 
-        self.batch_start += current_batch_size
-        return inputs, targets, current_batch_size
-        
     def load_folders(self, mode):
         '''
         Load the actual images from disk. While loading, we normalize the input data.
         '''
         self.reset()
         self.data = []
-        self.per_emotion_count = np.zeros(self.emotion_count, dtype=np.int)
+        self.per_emotion_count = np.zeros(self.emotion_count, dtype=np.int64)
+        votes         = []
+        distributions = []
         
         for folder_name in self.sub_folders: 
             logging.info("Loading %s" % (os.path.join(self.base_folder, folder_name)))
             folder_path = os.path.join(self.base_folder, folder_name)
             in_label_path = os.path.join(folder_path, self.label_file_name)
+            excluded      = self._load_exclude_list(folder_path)
             with open(in_label_path) as csvfile: 
                 emotion_label = csv.reader(csvfile) 
                 for row in emotion_label: 
+                    if row[0] in excluded:
+                        continue
+
                     # load the image
                     image_path = os.path.join(folder_path, row[0])
                     image_data = Image.open(image_path)
@@ -167,38 +251,42 @@ class FERPlusReader(object):
                     face_rc = Rect(box)
 
                     emotion_raw = list(map(float, row[2:len(row)]))
-                    emotion = self._process_data(emotion_raw, mode) 
+                    emotion = self._process_data(list(emotion_raw), mode) 
                     idx = np.argmax(emotion)
                     if idx < self.emotion_count: # not unknown or non-face 
                         emotion = emotion[:-2]
                         emotion = [float(i)/sum(emotion) for i in emotion]
-                        self.data.append((image_path, image_data, emotion, face_rc))
+                        self.data.append((image_path, image_data, face_rc))
+                        votes.append(emotion_raw)
+                        distributions.append(emotion)
                         self.per_emotion_count[idx] += 1
         
+        self.labels  = LabelStore(np.reshape(votes, (len(votes), -1)), 
+                                  np.reshape(distributions, (len(distributions), self.emotion_count)), 
+                                  mode)
         self.indices = np.arange(len(self.data))
         if self.shuffle:
-            np.random.shuffle(self.indices)
+            sample_rng(self.seed, SHUFFLE_STREAM).shuffle(self.indices)
     
-    def _process_target(self, target):
+    def _load_exclude_list(self, folder_path):
         '''
-        Based on https://arxiv.org/abs/1608.01041 the target depend on the training mode.
+        Return the set of image names listed in the exclude file of a folder, if any.
+        '''
+        excluded = set()
+        if self.exclude_file_name:
+            exclude_path = os.path.join(folder_path, self.exclude_file_name)
+            if os.path.exists(exclude_path):
+                with open(exclude_path) as exclude_file:
+                    excluded = set(line.strip() for line in exclude_file if line.strip())
+                logging.info("Excluding %d images listed in %s" % (len(excluded), exclude_path))
+        return excluded
 
-        Majority or crossentropy: return the probability distribution generated by "_process_data"
-        Probability: pick one emotion based on the probability distribtuion.
-        Multi-target: 
-        '''
-        if self.training_mode == 'majority' or self.training_mode == 'crossentropy': 
-            return target
-        elif self.training_mode == 'probability': 
-            idx             = np.random.choice(len(target), p=target) 
-            new_target      = np.zeros_like(target)
-            new_target[idx] = 1.0
-            return new_target
-        elif self.training_mode == 'multi_target': 
-            new_target = np.array(target) 
-            new_target[new_target>0] = 1.0
-            epsilon = 0.001     # add small epsilon in order to avoid ill-conditioned computation
-            return (1-epsilon)*new_target + epsilon*np.ones_like(target)
+    def set_indices(self, indices):
+        '''
+        Replace the order (and subset) of samples visited by the next epoch.
+        '''
+        self.indices = np.asarray(indices)
+        self.reset()
 
     def _process_data(self, emotion_raw, mode):
         '''
@@ -255,4 +343,121 @@ class FERPlusReader(object):
             if sum(emotion) <= 0.5 * sum_list: # less than 50% of the votes are integrated, we discard this example 
                 emotion = emotion_unknown   # set as unknown 
                                 
-        return [float(i)/sum(emotion) for i in emotion]
\ No newline at end of file
+        return [float(i)/sum(emotion) for i in emotion]
+
+class LabelStore(object):
+    '''
+    Columnar storage of the labels of a reader: the raw votes of each sample as uint8, its label distribution
+    from "_process_data" as float16, and the target matrix of the training mode as contiguous float32 so that
+    a minibatch is filled with a single gather.
+    '''
+    def __init__(self, votes, distributions, training_mode):
+        self.votes         = np.ascontiguousarray(votes, dtype=np.uint8)
+        self.distributions = np.ascontiguousarray(distributions, dtype=np.float16)
+        self.training_mode = training_mode
+        self.targets       = self.mode_view(training_mode)
+
+    def mode_view(self, mode):
+        '''
+        Based on https://arxiv.org/abs/1608.01041 the target depend on the training mode.
+
+        Majority or crossentropy: the probability distribution generated by "_process_data".
+        Probability: its cumulative distribution, "gather" picks one emotion per sample from it.
+        Multi-target: all emotions of the distribution with the same weight.
+        '''
+        distributions = self.distributions.astype(np.float32)
+        distributions = distributions / np.maximum(distributions.sum(axis=1, keepdims=True), 1e-6)
+        if mode == 'majority' or mode == 'crossentropy':
+            return np.ascontiguousarray(distributions)
+        elif mode == 'probability':
+            # close the distribution at its last non-zero emotion, so that rounding never picks a zero probability one.
+            size    = distributions.shape[1]
+            last    = size - 1 - np.argmax(distributions[:, ::-1] > 0, axis=1)
+            cdf     = np.cumsum(distributions, axis=1)
+            cdf[np.arange(size)[None, :] >= last[:, None]] = 1.0
+            return np.ascontiguousarray(cdf)
+        elif mode == 'multi_target':
+            epsilon = 0.001     # add small epsilon in order to avoid ill-conditioned computation
+            return np.ascontiguousarray((1-epsilon)*(distributions > 0) + epsilon, dtype=np.float32)
+        raise ValueError("Unknown training mode {}.".format(mode))
+
+    def gather(self, indices, uniforms = None):
+        '''
+        Return the targets of the given samples. In probability mode, uniforms holds one draw in [0, 1) per
+        sample used to pick its emotion.
+        '''
+        targets = self.targets[indices]
+        if self.training_mode == 'probability':
+            picked  = (targets <= np.asarray(uniforms)[:, None]).sum(axis=1)
+            targets = np.zeros_like(targets)
+            targets[np.arange(len(indices)), picked] = 1.0
+        return targets
+
+class HardExampleMiner(object):
+    '''
+    Online hard-example mining over the samples of a FERPlusReader.
+
+    The per-sample loss of every visited sample is recorded after each minibatch, and each epoch only
+    visits a fraction of the training set: samples with high loss or ambiguous votes are drawn more
+    often, while samples that were not scored for a few epochs are always revisited so that their
+    score does not go stale.
+    '''
+    def __init__(self, reader, sample_fraction = 0.5, uniform_fraction = 0.2, ambiguity_weight = 1.0, refresh_epochs = 4):
+        self.reader           = reader
+        self.sample_fraction  = sample_fraction
+        self.uniform_fraction = uniform_fraction
+        self.ambiguity_weight = ambiguity_weight
+        self.refresh_epochs   = refresh_epochs
+        self.epoch            = 0
+
+        size = reader.size()
+        self.loss       = np.zeros(size, dtype=np.float32)
+        self.last_epoch = np.full(size, -1, dtype=np.int64) # epoch in which each sample was last scored.
+        self.ambiguity  = self._vote_entropy(reader.labels.votes)
+
+    def next_epoch(self, epoch):
+        '''
+        Select the samples for the given epoch and hand them to the reader.
+        '''
+        size   = self.reader.size()
+        budget = int(math.ceil(self.sample_fraction * size))
+        rng    = sample_rng(self.reader.seed, MINING_STREAM, epoch)
+
+        # samples never scored, or scored too long ago, are always revisited.
+        stale   = (self.last_epoch < 0) | (epoch - self.last_epoch >= self.refresh_epochs)
+        forced  = np.flatnonzero(stale)
+        scored  = np.flatnonzero(~stale)
+        indices = forced
+
+        remaining = min(budget - len(forced), len(scored))
+        if remaining > 0:
+            score = self.loss[scored] * (1.0 + self.ambiguity_weight * self.ambiguity[scored])
+            total = score.sum()
+            if total > 0:
+                prob = (1.0 - self.uniform_fraction) * score / total + self.uniform_fraction / len(scored)
+            else:
+                prob = np.full(len(scored), 1.0 / len(scored))
+            prob    = prob / prob.sum()
+            picked  = rng.choice(scored, size=remaining, replace=False, p=prob)
+            indices = np.concatenate((forced, picked))
+
+        rng.shuffle(indices)
+        self.reader.set_indices(indices)
+        self.epoch = epoch
+
+    def update(self, indices, losses):
+        '''
+        Record the loss of each sample of the last minibatch, indices are the reader's "batch_indices".
+        '''
+        self.loss[indices]       = np.asarray(losses, dtype=np.float32).reshape(len(indices))
+        self.last_epoch[indices] = self.epoch
+
+    def _vote_entropy(self, votes):
+        '''
+        Normalized entropy of the raw votes of each sample, 0 when all taggers agree and 1 when the votes are uniform.
+        '''
+        votes = votes.astype(np.float32)
+        total = np.maximum(votes.sum(axis=1, keepdims=True), 1.0)
+        prob  = votes / total
+        plogp = np.where(prob > 0, prob * np.log(np.maximum(prob, 1e-12)), 0.0)
+        return (-plogp.sum(axis=1) / np.log(votes.shape[1])).astype(np.float32)
@@ -0,0 +1,161 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import os
+import csv
+import argparse
+import numpy as np
+from PIL import Image
+from scipy.fftpack import dct
+
+# Folders in order of priority: when an image is duplicated across folders, the copy in the first folder
+# is kept and the others are excluded, so that evaluation sets stay intact.
+folders = ['FER2013Test', 'FER2013Valid', 'FER2013Train']
+
+# number of bits set in each byte value.
+_bit_count = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def perceptual_hash(image, hash_size = 8, highfreq_factor = 4):
+    '''
+    64 bits DCT hash of an image: the lowest frequencies of its DCT compared to their median.
+    '''
+    size   = hash_size * highfreq_factor
+    pixels = np.asarray(image.convert('L').resize((size, size), Image.LANCZOS), dtype=np.float64)
+    coeffs = dct(dct(pixels, axis=0, norm='ortho'), axis=1, norm='ortho')[:hash_size, :hash_size]
+    bits   = (coeffs > np.median(coeffs)).flatten()
+    return np.packbits(bits).view('>u8')[0]
+
+def hamming_distance(hashes_a, hashes_b):
+    '''
+    Number of differing bits between two arrays of 64 bits hashes.
+    '''
+    diff = np.bitwise_xor(np.asarray(hashes_a, dtype=np.uint64), np.asarray(hashes_b, dtype=np.uint64))
+    return _bit_count[diff.reshape(-1, 1).view(np.uint8)].sum(axis=1)
+
+def band_masks(band_count):
+    '''
+    Split the 64 bits into band_count contiguous bands, two hashes within band_count-1 bits of each
+    other are identical on at least one band.
+    '''
+    bounds = np.linspace(0, 64, band_count + 1).astype(int)
+    return [np.uint64(((1 << int(end - start)) - 1) << int(start)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+def find_near_duplicates(hashes, max_distance):
+    '''
+    Return (i, j, distance) for every pair of hashes within max_distance bits. Each band of the hashes
+    is used as an exact lookup key, and only the hashes sharing a band value are compared.
+    '''
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    pairs  = {}
+    for mask in band_masks(max_distance + 1):
+        keys           = np.bitwise_and(hashes, mask)
+        order          = np.argsort(keys, kind='stable')
+        sorted_keys    = keys[order]
+        group_starts   = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        group_ends     = np.r_[group_starts[1:], len(order)]
+        for start, end in zip(group_starts, group_ends):
+            if end - start < 2:
+                continue
+            members = np.sort(order[start:end])
+            for k in range(len(members) - 1):
+                others    = members[k+1:]
+                distances = hamming_distance(np.full(len(others), hashes[members[k]]), hashes[others])
+                for other, distance in zip(others[distances <= max_distance], distances[distances <= max_distance]):
+                    pairs[(int(members[k]), int(other))] = int(distance)
+    return sorted((i, j, d) for (i, j), d in pairs.items())
+
+def select_excluded(images, pairs):
+    '''
+    Return the indices of the images to exclude given the near-duplicate pairs (i, j, distance), where i comes
+    before j in the folder priority order. An image of a lower priority folder is always excluded when it
+    matches an image of another folder, since that image stays in its set whether or not it is itself
+    excluded. Within a folder, one image of each pair is kept unless its match was already excluded.
+    '''
+    excluded = set()
+    for i, j, _ in pairs:
+        if images[i][0] != images[j][0] or i not in excluded:
+            excluded.add(j)
+    return excluded
+
+def load_hashes(base_folder, label_file_name):
+    '''
+    Return the (folder, image name) of every image listed in the label files, along with its hash.
+    '''
+    images = []
+    hashes = []
+    for folder_name in folders:
+        folder_path   = os.path.join(base_folder, folder_name)
+        in_label_path = os.path.join(folder_path, label_file_name)
+        if not os.path.exists(in_label_path):
+            continue
+        print("Hashing %s" % folder_path)
+        with open(in_label_path) as csvfile:
+            for row in csv.reader(csvfile):
+                image_path = os.path.join(folder_path, row[0])
+                if not os.path.exists(image_path):
+                    continue
+                images.append((folder_name, row[0]))
+                hashes.append(perceptual_hash(Image.open(image_path)))
+    return images, np.array(hashes, dtype=np.uint64)
+
+def main(base_folder, max_distance, report_path, label_file_name, exclude_file_name):
+    '''
+    Find duplicate and near-duplicate images across the FER+ folders, write a report of all the pairs
+    and an exclusion list per folder that FERPlusReader honors.
+
+    Args:
+        base_folder(str): The base folder that contains 'FER2013Train', 'FER2013Valid' and 'FER2013Test'.
+        max_distance(int): Maximum Hamming distance between the hashes of near-duplicates.
+        report_path(str): Path of the CSV report listing each pair and its distance.
+        label_file_name(str): Name of the label file in each folder.
+        exclude_file_name(str): Name of the exclusion list written in each folder.
+    '''
+    images, hashes = load_hashes(base_folder, label_file_name)
+    pairs = find_near_duplicates(hashes, max_distance)
+
+    # for each pair keep the image of the highest priority folder, or the first one within a folder.
+    excluded = select_excluded(images, pairs)
+    with open(report_path, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['folder_a', 'image_a', 'folder_b', 'image_b', 'distance'])
+        for i, j, distance in pairs:
+            writer.writerow([images[i][0], images[i][1], images[j][0], images[j][1], distance])
+
+    for folder_name in folders:
+        folder_path = os.path.join(base_folder, folder_name)
+        if not os.path.exists(folder_path):
+            continue
+        names = sorted(images[i][1] for i in excluded if images[i][0] == folder_name)
+        with open(os.path.join(folder_path, exclude_file_name), 'w') as exclude_file:
+            exclude_file.writelines(name + '\n' for name in names)
+        print("{}: {} images excluded".format(folder_name, len(names)))
+
+    print("Found {} near-duplicate pairs among {} images.".format(len(pairs), len(images)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d",
+                        "--base_folder",
+                        type = str,
+                        help = "Base folder containing the training, validation and testing folder.",
+                        required = True)
+    parser.add_argument("-t",
+                        "--max_distance",
+                        type = int,
+                        default = 4,
+                        help = "Maximum Hamming distance between the 64 bits hashes of near-duplicate images.")
+    parser.add_argument("-o",
+                        "--report_path",
+                        type = str,
+                        default = "duplicates.csv",
+                        help = "Path of the CSV report listing every near-duplicate pair.")
+    parser.add_argument("-e",
+                        "--exclude_file_name",
+                        type = str,
+                        default = "exclude.txt",
+                        help = "Name of the exclusion list written in each folder.")
+
+    args = parser.parse_args()
+    main(args.base_folder, args.max_distance, args.report_path, "label.csv", args.exclude_file_name)
@@ -6,8 +6,11 @@
 import numpy as np
 import random as rnd
 from PIL import Image
-from scipy import ndimage
 from rect_util import Rect
+from lazy_import import LazyModule
+
+# scipy is only needed once images are cropped.
+ndimage = LazyModule('scipy.ndimage')
 
 def compute_norm_mat(base_width, base_height): 
     # normalization matrix used in image pre-processing 
@@ -40,26 +43,53 @@ def preproc_img(img, A, A_pinv):
         diff = diff/std
     return diff.reshape(img.shape)
 
-def distort_img(img, roi, out_width, out_height, max_shift, max_scale, max_angle, max_skew, flip=True): 
-    shift_y = out_height*max_shift*rnd.uniform(-1.0,1.0)
-    shift_x = out_width*max_shift*rnd.uniform(-1.0,1.0)
+# distortion that leaves the face crop unchanged 
+no_distortion = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0, False, 0.0, False, False)
+
+def sample_distortion(rng=None): 
+    # random draws of one distortion, independent of the image and output size so they can be stored and replayed. 
+    # rng is a numpy Generator, the global random module is used when it is None. 
+    if rng is not None: 
+        u = rng.random(10) 
+        return (2.0*u[0]-1.0, 2.0*u[1]-1.0, 2.0*u[2]-1.0, 2.0*u[3]-1.0, 2.0*u[4]-1.0, 
+                u[5], bool(u[6] < 0.5), u[7], bool(u[8] < 0.5), bool(u[9] < 0.5))
+
+    shift_y = rnd.uniform(-1.0,1.0)
+    shift_x = rnd.uniform(-1.0,1.0)
+    angle   = rnd.uniform(-1.0,1.0)
+    sk_y    = rnd.uniform(-1.0,1.0)
+    sk_x    = rnd.uniform(-1.0,1.0)
+    scale_y = rnd.uniform(0.0,1.0)
+    inv_y   = rnd.choice([True, False])
+    scale_x = rnd.uniform(0.0,1.0)
+    inv_x   = rnd.choice([True, False])
+    flip    = rnd.choice([True, False])
+    return (shift_y, shift_x, angle, sk_y, sk_x, scale_y, inv_y, scale_x, inv_x, flip)
+
+def distort_img(img, roi, out_width, out_height, max_shift, max_scale, max_angle, max_skew, flip=True, distortion=None): 
+    if distortion is None: 
+        distortion = sample_distortion()
+    u_shift_y, u_shift_x, u_angle, u_sk_y, u_sk_x, u_scale_y, inv_y, u_scale_x, inv_x, do_flip = distortion
+
+    shift_y = out_height*max_shift*u_shift_y
+    shift_x = out_width*max_shift*u_shift_x
 
     # rotation angle 
-    angle = max_angle*rnd.uniform(-1.0,1.0)
+    angle = max_angle*u_angle
 
     #skew 
-    sk_y = max_skew*rnd.uniform(-1.0, 1.0)
-    sk_x = max_skew*rnd.uniform(-1.0, 1.0)
+    sk_y = max_skew*u_sk_y
+    sk_x = max_skew*u_sk_x
 
     # scale 
-    scale_y = rnd.uniform(1.0, max_scale) 
-    if rnd.choice([True, False]): 
+    scale_y = 1.0 + (max_scale-1.0)*u_scale_y 
+    if inv_y: 
         scale_y = 1.0/scale_y 
-    scale_x = rnd.uniform(1.0, max_scale) 
-    if rnd.choice([True, False]): 
+    scale_x = 1.0 + (max_scale-1.0)*u_scale_x 
+    if inv_x: 
         scale_x = 1.0/scale_x 
     T_im = crop_img(img, roi, out_width, out_height, shift_x, shift_y, scale_x, scale_y, angle, sk_x, sk_y)
-    if flip and rnd.choice([True, False]): 
+    if flip and do_flip: 
         T_im = np.fliplr(T_im)
     return T_im
 
@@ -0,0 +1,20 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import importlib
+
+class LazyModule(object):
+    '''
+    Stand-in for a heavyweight module (CNTK, SciPy...) that imports it on first attribute access, so that
+    the data tools can be imported quickly and on machines where the module is missing.
+    '''
+    def __init__(self, name):
+        self._name   = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
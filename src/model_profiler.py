@@ -0,0 +1,203 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import time
+import argparse
+import numpy as np
+from collections import namedtuple
+from numpy.lib.stride_tricks import sliding_window_view
+
+import models
+
+LayerCost = namedtuple('LayerCost', ['name', 'kind', 'output_shape', 'params', 'activation_bytes', 'flops'])
+
+def layer_cost(layer, shape):
+    '''
+    Return the output shape, parameter count and forward FLOPs per image of a layer applied to an input
+    of the given shape, (channels, height, width) for convolutional layers or (units,) after a dense layer.
+    '''
+    if layer.kind == 'conv':
+        channels, height, width = shape
+        out_shape = (layer.units, (height - 1) // layer.stride + 1, (width - 1) // layer.stride + 1)
+        fan_in    = (channels // layer.groups) * layer.size * layer.size
+        params    = layer.units * fan_in + layer.units
+        flops     = 2 * fan_in * np.prod(out_shape)
+    elif layer.kind == 'pool':
+        channels, height, width = shape
+        out_shape = (channels, height // layer.stride, width // layer.stride)
+        params    = 0
+        flops     = layer.size * layer.size * np.prod(out_shape)
+    elif layer.kind == 'gap':
+        out_shape = (shape[0], 1, 1)
+        params    = 0
+        flops     = np.prod(shape)
+    elif layer.kind == 'dense':
+        fan_in    = int(np.prod(shape))
+        out_shape = (layer.units,)
+        params    = fan_in * layer.units + layer.units
+        flops     = 2 * fan_in * layer.units
+    elif layer.kind == 'relu':
+        out_shape = shape
+        params    = 0
+        flops     = np.prod(shape)
+    elif layer.kind == 'dropout':
+        out_shape = shape
+        params    = 0
+        flops     = 0
+    else:
+        raise ValueError("Unknown layer kind {}.".format(layer.kind))
+    return tuple(out_shape), int(params), int(flops)
+
+def profile_model(model_name, num_classes, batch_size):
+    '''
+    Return the cost of each layer of a registered model for a minibatch of batch_size images, activations
+    are counted as float32.
+    '''
+    model_class = models.get_model_class(model_name)
+    shape       = (model_class.input_channels, model_class.input_height, model_class.input_width)
+    costs       = []
+    for layer in model_class.layers(num_classes):
+        shape, params, flops = layer_cost(layer, shape)
+        costs.append(LayerCost(layer.name, layer.kind, shape, params, 4 * batch_size * int(np.prod(shape)), batch_size * flops))
+    return costs
+
+class ReferenceModel(object):
+    '''
+    NumPy implementation of the inference graph of a registered model with random weights, used to measure
+    CPU forward latency without the training toolkit.
+    '''
+    def __init__(self, model_name, num_classes, seed = 0):
+        model_class = models.get_model_class(model_name)
+        rng         = np.random.RandomState(seed)
+
+        self.input_shape = (model_class.input_channels, model_class.input_height, model_class.input_width)
+        self.layers      = model_class.layers(num_classes)
+        self.weights     = []
+
+        shape = self.input_shape
+        for layer in self.layers:
+            out_shape, _, _ = layer_cost(layer, shape)
+            if layer.kind == 'conv':
+                w_shape = (layer.units, shape[0] // layer.groups, layer.size, layer.size)
+            elif layer.kind == 'dense':
+                w_shape = (int(np.prod(shape)), layer.units)
+            else:
+                w_shape = None
+
+            if w_shape:
+                limit = np.sqrt(6.0 / (np.prod(w_shape[1:]) + w_shape[0]))
+                self.weights.append((rng.uniform(-limit, limit, w_shape).astype(np.float32),
+                                     np.zeros(layer.units, dtype=np.float32)))
+            else:
+                self.weights.append(None)
+            shape = out_shape
+
+    def forward(self, x):
+        '''
+        Return the output of the model for a minibatch x of shape (batch, channels, height, width).
+        '''
+        for layer, weights in zip(self.layers, self.weights):
+            if layer.kind == 'conv':
+                x = _conv2d(x, weights[0], weights[1], layer.stride, layer.groups)
+            elif layer.kind == 'pool':
+                n, c, h, w = x.shape
+                s = layer.stride
+                x = x[:, :, :h//s*s, :w//s*s].reshape(n, c, h//s, s, w//s, s).max(axis=(3, 5))
+            elif layer.kind == 'gap':
+                x = x.mean(axis=(2, 3), keepdims=True)
+            elif layer.kind == 'dense':
+                x = np.dot(x.reshape(x.shape[0], -1), weights[0]) + weights[1]
+
+            if layer.activation:
+                x = np.maximum(x, 0.0)
+        return x
+
+def _conv2d(x, w, b, stride, groups):
+    '''
+    Grouped 2D convolution with "same" padding, computed on strided windows of the input.
+    '''
+    n, c, _, _     = x.shape
+    f, cg, k, _    = w.shape
+    pad = (k - 1) // 2
+    if pad > 0:
+        x = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)))
+
+    windows = sliding_window_view(x, (k, k), axis=(2, 3))[:, :, ::stride, ::stride]
+    oh, ow  = windows.shape[2:4]
+    if groups == 1:
+        y = np.tensordot(windows, w, axes=([1, 4, 5], [1, 2, 3])).transpose(0, 3, 1, 2)
+    else:
+        windows = windows.reshape(n, groups, cg, oh, ow, k, k)
+        y = np.einsum('ngchwij,gfcij->ngfhw', windows, w.reshape(groups, f // groups, cg, k, k)).reshape(n, f, oh, ow)
+    return y + b[None, :, None, None]
+
+def measure_latency(model_name, num_classes, batch_size, repeat):
+    '''
+    Return the median forward time in seconds of the NumPy reference model for one minibatch.
+    '''
+    model  = ReferenceModel(model_name, num_classes)
+    inputs = np.random.randn(batch_size, *model.input_shape).astype(np.float32)
+    model.forward(inputs) # warm up.
+
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        model.forward(inputs)
+        timings.append(time.time() - start_time)
+    return float(np.median(timings))
+
+def main(model_names, num_classes, batch_size, latency_batch_size, repeat):
+    '''
+    Print the per layer cost of each model followed by its totals and measured CPU latency.
+    '''
+    for model_name in model_names:
+        costs = profile_model(model_name, num_classes, batch_size)
+
+        print("{} (batch size {})".format(model_name, batch_size))
+        print("{0}\t{1}\t{2}\t{3}\t{4}".format("layer".ljust(12), "output".ljust(16), "params".rjust(10), "act MB".rjust(8), "MFLOPs".rjust(10)))
+        for cost in costs:
+            print("{0}\t{1}\t{2:10d}\t{3:8.2f}\t{4:10.1f}".format(cost.name.ljust(12),
+                                                               str(cost.output_shape).ljust(16),
+                                                               cost.params,
+                                                               cost.activation_bytes / 2.0**20,
+                                                               cost.flops / 1e6))
+
+        params = sum(cost.params for cost in costs)
+        flops  = sum(cost.flops for cost in costs)
+        memory = sum(cost.activation_bytes for cost in costs)
+        print("Total: {:,} parameters ({:.2f} MB), {:.2f} MB activations, {:.3f} GFLOPs forward".format(
+              params, 4 * params / 2.0**20, memory / 2.0**20, flops / 1e9))
+
+        if repeat > 0:
+            latency = measure_latency(model_name, num_classes, latency_batch_size, repeat)
+            print("CPU forward latency: {:.2f} ms per minibatch of {}, {:.2f} ms per image".format(
+                  latency * 1000, latency_batch_size, latency * 1000 / latency_batch_size))
+        print("")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n",
+                        "--model_name",
+                        type = str,
+                        nargs = '*',
+                        help = "Models to profile, all registered models by default.")
+    parser.add_argument("-b",
+                        "--batch_size",
+                        type = int,
+                        default = 32,
+                        help = "Minibatch size used for the activation memory and FLOPs.")
+    parser.add_argument("-l",
+                        "--latency_batch_size",
+                        type = int,
+                        default = 1,
+                        help = "Minibatch size used to measure the CPU forward latency.")
+    parser.add_argument("-r",
+                        "--repeat",
+                        type = int,
+                        default = 10,
+                        help = "Number of timed forward passes, 0 to skip the latency measurement.")
+
+    args = parser.parse_args()
+    main(args.model_name or models.model_names(), 8, args.batch_size, args.latency_batch_size, args.repeat)
@@ -7,67 +7,221 @@ import os
 import sys
 import math
 import numpy as np
-import cntk as ct
+from collections import namedtuple
+from lazy_import import LazyModule
+
+# CNTK is only imported when a model is actually built, the layer descriptions don't need it.
+ct = LazyModule('cntk')
+
+# Declarative description of one layer, shared by the CNTK builder and the cost profiler.
+Layer = namedtuple('Layer', ['kind', 'name', 'units', 'size', 'stride', 'groups', 'activation', 'rate'])
+
+def conv(name, filters, size=3, stride=1, groups=1):
+    ''' Convolution with "same" padding followed by relu. '''
+    return Layer('conv', name, filters, size, stride, groups, True, None)
+
+def max_pool(name, size=2):
+    ''' Max pooling with non overlapping windows. '''
+    return Layer('pool', name, None, size, size, 1, False, None)
+
+def global_avg_pool(name):
+    ''' Average over the whole spatial extent. '''
+    return Layer('gap', name, None, None, None, 1, False, None)
+
+def dense(name, units, activation=False):
+    ''' Fully connected layer. '''
+    return Layer('dense', name, units, None, None, 1, activation, None)
+
+def relu(name):
+    ''' Standalone relu, so that the pre-activation output keeps its own name. '''
+    return Layer('relu', name, None, None, None, 1, True, None)
+
+def dropout(name, rate):
+    ''' Dropout, identity at inference. '''
+    return Layer('dropout', name, None, None, None, 1, False, rate)
+
+_model_registry = {}
+
+def register_model(cls):
+    '''
+    Class decorator that makes a model available to build_model under its class name.
+    '''
+    _model_registry[cls.__name__] = cls
+    return cls
+
+def model_names():
+    '''
+    Return the names of all registered models.
+    '''
+    return sorted(_model_registry.keys())
+
+def get_model_class(model_name):
+    '''
+    Return the registered class of the given model name.
+    '''
+    if model_name not in _model_registry:
+        raise ValueError("Unknown model {}, available models: {}.".format(model_name, ", ".join(model_names())))
+    return _model_registry[model_name]
 
 def build_model(num_classes, model_name):
     '''
     Factory function to instantiate the model.
     '''
-    model = getattr(sys.modules[__name__], model_name)
-    return model(num_classes)
+    return get_model_class(model_name)(num_classes)
 
-class VGG13(object):
+def resize_nearest(x, height, width):
     '''
-    A VGG13 like model (https://arxiv.org/pdf/1409.1556.pdf) tweaked for emotion data.
+    Nearest neighbor resize of a (channels, height, width) tensor.
     '''
-    @property
-    def learning_rate(self):
-        return 0.05
-
-    @property
-    def input_width(self):
-        return 64
+    _, in_height, in_width = x.shape
+    if in_height != height:
+        rows = [(i * in_height) // height for i in range(height)]
+        x = ct.splice(*[ct.slice(x, 1, r, r + 1) for r in rows], axis=1)
+    if in_width != width:
+        cols = [(i * in_width) // width for i in range(width)]
+        x = ct.splice(*[ct.slice(x, 2, c, c + 1) for c in cols], axis=2)
+    return x
 
-    @property
-    def input_height(self):
-        return 64
+def _create_layer(layer):
+    '''
+    Create the CNTK layer of a layer description.
+    '''
+    activation = ct.relu if layer.activation else None
+    if layer.kind == 'conv':
+        options = {'groups': layer.groups} if layer.groups > 1 else {}
+        return ct.layers.Convolution((layer.size, layer.size), layer.units, activation=activation, pad=True,
+                                     strides=(layer.stride, layer.stride), name=layer.name, **options)
+    elif layer.kind == 'pool':
+        return ct.layers.MaxPooling((layer.size, layer.size), strides=(layer.stride, layer.stride), name=layer.name)
+    elif layer.kind == 'gap':
+        return ct.layers.GlobalAveragePooling(name=layer.name)
+    elif layer.kind == 'dense':
+        return ct.layers.Dense(layer.units, activation=activation, name=layer.name)
+    elif layer.kind == 'relu':
+        return ct.layers.Activation(activation=ct.relu, name=layer.name)
+    elif layer.kind == 'dropout':
+        return ct.layers.Dropout(layer.rate, name=layer.name)
+    raise ValueError("Unknown layer kind {}.".format(layer.kind))
 
-    @property
-    def input_channels(self):
-        return 1
+class FERModel(object):
+    '''
+    Base class of the registered models. Each model declares its input size, learning rate and layers, split
+    between the convolutional features and the classifier that follows them. The final "output" layer with
+    one unit per class is appended to the classifier.
+    '''
+    learning_rate  = 0.05
+    input_width    = 64
+    input_height   = 64
+    input_channels = 1
+    features       = []
+    classifier     = []
 
-    @property
-    def model(self):
-        return None
+    @classmethod
+    def layers(cls, num_classes):
+        '''
+        Return the full list of layer descriptions.
+        '''
+        return cls.features + cls.classifier + [dense('output', num_classes)]
 
     @property
     def model(self):
         return self._model
 
     def __init__(self, num_classes):
-        self._model = self._create_model(num_classes)
+        self._features, self._classifier = self._create_model(num_classes)
+        self._model = ct.layers.Sequential([self._features, self._classifier])
+
+    def model_for_size(self, width, height):
+        '''
+        Return the model applied to a different input size, sharing the same parameters. Unless the classifier
+        starts with a global pooling, the feature maps are resized back to the size the classifier expects, so
+        the expensive convolutions run at the reduced resolution.
+        '''
+        if width == self.input_width and height == self.input_height:
+            return self._model
+        if self.classifier and self.classifier[0].kind == 'gap':
+            return self._model
+
+        native_input = ct.input((self.input_channels, self.input_height, self.input_width), np.float32)
+        _, feature_height, feature_width = self._features(native_input).shape
+        return lambda x: self._classifier(resize_nearest(self._features(x), feature_height, feature_width))
 
     def _create_model(self, num_classes):
-        with ct.default_options(activation=ct.relu, init=ct.glorot_uniform()):
-            model = ct.layers.Sequential([
-                ct.layers.For(range(2), lambda i: [
-                    ct.layers.Convolution((3,3), [64,128][i], pad=True, name='conv{}-1'.format(i+1)),
-                    ct.layers.Convolution((3,3), [64,128][i], pad=True, name='conv{}-2'.format(i+1)),
-                    ct.layers.MaxPooling((2,2), strides=(2,2), name='pool{}-1'.format(i+1)),
-                    ct.layers.Dropout(0.25, name='drop{}-1'.format(i+1))
-                ]),
-                ct.layers.For(range(2), lambda i: [
-                    ct.layers.Convolution((3,3), [256,256][i], pad=True, name='conv{}-1'.format(i+3)),
-                    ct.layers.Convolution((3,3), [256,256][i], pad=True, name='conv{}-2'.format(i+3)),
-                    ct.layers.Convolution((3,3), [256,256][i], pad=True, name='conv{}-3'.format(i+3)),                
-                    ct.layers.MaxPooling((2,2), strides=(2,2), name='pool{}-1'.format(i+3)),
-                    ct.layers.Dropout(0.25, name='drop{}-1'.format(i+3))
-                ]),            
-                ct.layers.For(range(2), lambda i: [
-                    ct.layers.Dense(1024, activation=None, name='fc{}'.format(i+5)),
-                    ct.layers.Activation(activation=ct.relu, name='relu{}'.format(i+5)),
-                    ct.layers.Dropout(0.5, name='drop{}'.format(i+5))
-                ]),
-                ct.layers.Dense(num_classes, activation=None, name='output')
-            ])
-        return model
+        with ct.default_options(init=ct.glorot_uniform()):
+            features   = ct.layers.Sequential([_create_layer(layer) for layer in self.features])
+            classifier = ct.layers.Sequential([_create_layer(layer) for layer in self.classifier + [dense('output', num_classes)]])
+        return features, classifier
+
+@register_model
+class VGG13(FERModel):
+    '''
+    A VGG13 like model (https://arxiv.org/pdf/1409.1556.pdf) tweaked for emotion data.
+    '''
+    learning_rate = 0.05
+    input_width   = 64
+    input_height  = 64
+
+    features = [layer for i, filters in enumerate([64, 128]) for layer in [
+                    conv('conv{}-1'.format(i+1), filters),
+                    conv('conv{}-2'.format(i+1), filters),
+                    max_pool('pool{}-1'.format(i+1)),
+                    dropout('drop{}-1'.format(i+1), 0.25)]] + \
+               [layer for i, filters in enumerate([256, 256]) for layer in [
+                    conv('conv{}-1'.format(i+3), filters),
+                    conv('conv{}-2'.format(i+3), filters),
+                    conv('conv{}-3'.format(i+3), filters),
+                    max_pool('pool{}-1'.format(i+3)),
+                    dropout('drop{}-1'.format(i+3), 0.25)]]
+
+    classifier = [layer for i in range(2) for layer in [
+                    dense('fc{}'.format(i+5), 1024),
+                    relu('relu{}'.format(i+5)),
+                    dropout('drop{}'.format(i+5), 0.5)]]
+
+@register_model
+class VGG13Slim(FERModel):
+    '''
+    A narrow version of VGG13 with a quarter of the convolution channels and a global average pooling
+    head instead of the large fully connected layers, meant to be distilled from VGG13.
+    '''
+    learning_rate = 0.05
+    input_width   = 64
+    input_height  = 64
+
+    features = [layer for i, filters in enumerate([16, 32]) for layer in [
+                    conv('conv{}-1'.format(i+1), filters),
+                    conv('conv{}-2'.format(i+1), filters),
+                    max_pool('pool{}-1'.format(i+1)),
+                    dropout('drop{}-1'.format(i+1), 0.25)]] + \
+               [layer for i, filters in enumerate([64, 64]) for layer in [
+                    conv('conv{}-1'.format(i+3), filters),
+                    conv('conv{}-2'.format(i+3), filters),
+                    conv('conv{}-3'.format(i+3), filters),
+                    max_pool('pool{}-1'.format(i+3)),
+                    dropout('drop{}-1'.format(i+3), 0.25)]]
+
+    classifier = [global_avg_pool('gap'),
+                  dense('fc5', 128),
+                  relu('relu5'),
+                  dropout('drop5', 0.5)]
+
+@register_model
+class MobileFER(FERModel):
+    '''
+    A compact model built from depthwise separable convolutions (https://arxiv.org/abs/1704.04861), a
+    3x3 depthwise convolution per channel followed by a 1x1 pointwise convolution.
+    '''
+    learning_rate = 0.05
+    input_width   = 64
+    input_height  = 64
+
+    # (input channels, output channels, stride) of each depthwise separable block.
+    blocks = [(32, 64, 1), (64, 128, 2), (128, 128, 1), (128, 256, 2), (256, 256, 1)]
+
+    features = [conv('conv1', 32, stride=2)] + \
+               [layer for i, (channels, filters, stride) in enumerate(blocks) for layer in [
+                    conv('conv{}-dw'.format(i+2), channels, stride=stride, groups=channels),
+                    conv('conv{}-pw'.format(i+2), filters, size=1)]]
+
+    classifier = [global_avg_pool('gap'),
+                  dropout('drop', 0.5)]
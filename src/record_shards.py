@@ -0,0 +1,299 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import io
+import os
+import csv
+import glob
+import struct
+import logging
+import argparse
+import numpy as np
+
+from PIL import Image
+from rect_util import Rect
+from ferplus import FERPlusReader, LabelStore, sample_rng, AUGMENTATION_STREAM, SHUFFLE_STREAM
+
+# Shard layout: a fixed header, the compressed images back to back, then the index with one entry per
+# image. The index is written last so that shards are produced in a single sequential pass.
+SHARD_MAGIC   = b'FERS'
+SHARD_VERSION = 1
+SHARD_HEADER  = struct.Struct('<4sIIIQ') # magic, version, record count, vote count, index offset.
+
+def index_dtype(vote_count):
+    '''
+    Numpy type of one index entry: where the compressed image is in the shard, its face box and its votes.
+    '''
+    return np.dtype([('offset', '<u8'), ('length', '<u4'), ('box', '<i4', (4,)), ('votes', 'u1', (vote_count,))])
+
+def read_shard_index(shard_path):
+    '''
+    Return the index of a shard without reading its images.
+    '''
+    with open(shard_path, 'rb') as shard_file:
+        magic, version, count, vote_count, index_offset = SHARD_HEADER.unpack(shard_file.read(SHARD_HEADER.size))
+        if magic != SHARD_MAGIC or version != SHARD_VERSION:
+            raise ValueError("{} is not a version {} FER+ shard.".format(shard_path, SHARD_VERSION))
+        shard_file.seek(index_offset)
+        return np.frombuffer(shard_file.read(count * index_dtype(vote_count).itemsize), dtype=index_dtype(vote_count), count=count)
+
+def read_shard(shard_path):
+    '''
+    Read a whole shard with one sequential read, return its content and its index.
+    '''
+    with open(shard_path, 'rb') as shard_file:
+        blob = shard_file.read()
+    magic, version, count, vote_count, index_offset = SHARD_HEADER.unpack_from(blob)
+    if magic != SHARD_MAGIC or version != SHARD_VERSION:
+        raise ValueError("{} is not a version {} FER+ shard.".format(shard_path, SHARD_VERSION))
+    return blob, np.frombuffer(blob, dtype=index_dtype(vote_count), count=count, offset=index_offset)
+
+class ShardWriter(object):
+    '''
+    Write records (compressed image, face box and votes) into shards of about shard_size bytes each.
+    '''
+    def __init__(self, out_folder, shard_size = 64 * 2**20, vote_count = 10):
+        self.out_folder  = out_folder
+        self.shard_size  = shard_size
+        self.vote_count  = vote_count
+        self.shard_count = 0
+        self.count       = 0
+        self._file       = None
+        if not os.path.exists(out_folder):
+            os.makedirs(out_folder)
+
+    def add(self, image_bytes, box, votes):
+        '''
+        Append one record, image_bytes is the content of an encoded image file (PNG, JPEG...). Votes are
+        stored on one byte each.
+        '''
+        if len(votes) != self.vote_count:
+            raise ValueError("Expected {} votes per record, got {}.".format(self.vote_count, len(votes)))
+        if min(votes) < 0 or max(votes) > 255:
+            raise ValueError("Vote counts must be between 0 and 255, got {}.".format(list(votes)))
+        if self._file is None:
+            self._open()
+        self._index.append((self._file.tell(), len(image_bytes), box, votes))
+        self._file.write(image_bytes)
+        self.count += 1
+        if self._file.tell() >= self.shard_size:
+            self._close_shard()
+
+    def close(self):
+        '''
+        Flush the last shard.
+        '''
+        if self._file is not None:
+            self._close_shard()
+
+    def _open(self):
+        path         = os.path.join(self.out_folder, "shard-{:05d}.fer".format(self.shard_count))
+        self._file   = open(path, 'wb')
+        self._index  = []
+        self._file.write(SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, 0, self.vote_count, 0))
+
+    def _close_shard(self):
+        index_offset = self._file.tell()
+        self._file.write(np.array(self._index, dtype=index_dtype(self.vote_count)).tobytes())
+        self._file.seek(0)
+        self._file.write(SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, len(self._index), self.vote_count, index_offset))
+        self._file.close()
+        self._file        = None
+        self.shard_count += 1
+
+class ShardReader(FERPlusReader):
+    '''
+    Streaming reader over a folder of shards, for datasets that don't fit in memory. Each epoch visits the
+    shards in a random order, reading each one sequentially in full, and the samples are shuffled within a
+    buffer of buffer_size samples spanning several shards. It has the same minibatch interface as
+    FERPlusReader, the labels of all samples are kept in memory but the images are not.
+    '''
+    @classmethod
+    def create(cls, shard_folder, parameters, buffer_size = 100000):
+        '''
+        Factory function that create an instance of ShardReader and load the shard indexes.
+        '''
+        reader = cls(shard_folder, parameters, buffer_size)
+        reader.load_folders(parameters.training_mode)
+        return reader
+
+    def __init__(self, shard_folder, parameters, buffer_size = 100000):
+        super(ShardReader, self).__init__(shard_folder, [], None, parameters)
+        self.shard_paths   = sorted(glob.glob(os.path.join(shard_folder, '*.fer')))
+        self.buffer_size   = buffer_size
+        self.shard_samples = []
+        self.buffer        = []
+        self.shard_order   = None
+        self.next_shard    = 0
+        self.batch_images  = {}
+
+    def load_folders(self, mode):
+        '''
+        Read the index of every shard and process the votes of all records, records that are unknown or
+        not a face are dropped.
+        '''
+        self.reset()
+        self.per_emotion_count = np.zeros(self.emotion_count, dtype=np.int64)
+        self.shard_samples     = []
+        votes         = []
+        distributions = []
+
+        for shard_path in self.shard_paths:
+            index   = read_shard_index(shard_path)
+            samples = np.full(len(index), -1, dtype=np.int64) # global sample id of each record, -1 if dropped.
+            for pos, record_votes in enumerate(index['votes']):
+                emotion_raw = list(map(float, record_votes))
+                emotion = self._process_data(list(emotion_raw), mode)
+                idx = np.argmax(emotion)
+                if idx < self.emotion_count: # not unknown or non-face
+                    emotion = emotion[:-2]
+                    samples[pos] = len(votes)
+                    votes.append(emotion_raw)
+                    distributions.append([float(i)/sum(emotion) for i in emotion])
+                    self.per_emotion_count[idx] += 1
+            self.shard_samples.append(samples)
+
+        logging.info("Indexed %d samples in %d shards of %s" % (len(votes), len(self.shard_paths), self.base_folder))
+        self.labels = LabelStore(np.reshape(votes, (len(votes), -1)),
+                                 np.reshape(distributions, (len(distributions), self.emotion_count)),
+                                 mode)
+
+    def size(self):
+        '''
+        Return the number of samples in all the shards.
+        '''
+        return len(self.labels.votes)
+
+    def reset(self):
+        '''
+        Start from beginning for the new epoch, the shard order is drawn when the first minibatch is read
+        so that it follows the epoch given to "set_epoch".
+        '''
+        self.buffer      = []
+        self.shard_order = None
+        self.next_shard  = 0
+
+    def has_more(self):
+        '''
+        Return True if there is more min-batches.
+        '''
+        if self.shard_order is None:
+            return self.size() > 0
+        return len(self.buffer) > 0 or self.next_shard < len(self.shard_order)
+
+    def set_indices(self, indices):
+        '''
+        Not supported, the samples are streamed from the shards.
+        '''
+        raise ValueError("ShardReader streams its samples and can't visit an arbitrary subset.")
+
+    def set_fixed_crops(self, crop_count):
+        '''
+        Not supported, the images are not kept in memory.
+        '''
+        raise ValueError("ShardReader doesn't keep the images needed for fixed crops.")
+
+    def next_minibatch(self, batch_size):
+        '''
+        Return the next mini-batch drawn at random from the shuffle buffer, which is topped up from the
+        next shards first.
+        '''
+        if self.shard_order is None:
+            self.shard_order = np.arange(len(self.shard_paths))
+            if self.shuffle:
+                sample_rng(self.seed, SHUFFLE_STREAM, self.epoch).shuffle(self.shard_order)
+            self.buffer_rng = sample_rng(self.seed, SHUFFLE_STREAM, self.epoch, 1)
+
+        while len(self.buffer) < self.buffer_size and self.next_shard < len(self.shard_order):
+            self._load_shard(self.shard_order[self.next_shard])
+            self.next_shard += 1
+
+        current_batch_size = min(batch_size, len(self.buffer))
+        if current_batch_size <= 0:
+            raise Exception('Reach the end of the training data.')
+
+        records = []
+        for _ in range(current_batch_size):
+            pos = self.buffer_rng.integers(len(self.buffer))
+            self.buffer[pos], self.buffer[-1] = self.buffer[-1], self.buffer[pos]
+            records.append(self.buffer.pop())
+
+        self.batch_indices = np.array([record[0] for record in records], dtype=np.int64)
+        self.batch_images  = {}
+        for sample, image_bytes, box in records:
+            image_data = Image.open(io.BytesIO(image_bytes)).convert('L')
+            self.batch_images[sample] = (np.asarray(image_data), Rect(list(box)))
+
+        rngs     = [sample_rng(self.seed, AUGMENTATION_STREAM, self.epoch, index) for index in self.batch_indices]
+        inputs   = self.images(self.batch_indices, None, rngs)
+        uniforms = np.array([rng.random() for rng in rngs]) if self.training_mode == 'probability' else None
+        targets  = self.labels.gather(self.batch_indices, uniforms)
+        return inputs, targets, current_batch_size
+
+    def _image(self, index):
+        return self.batch_images[index]
+
+    def _load_shard(self, shard):
+        blob, index = read_shard(self.shard_paths[shard])
+        samples     = self.shard_samples[shard]
+        for pos in np.flatnonzero(samples >= 0):
+            offset, length = int(index['offset'][pos]), int(index['length'][pos])
+            self.buffer.append((int(samples[pos]), blob[offset:offset+length], index['box'][pos]))
+
+def main(base_folder, sub_folders, out_folder, label_file_name, shard_size):
+    '''
+    Convert folders in the FER+ layout (image files and a label.csv with the face box and the votes of
+    each image) into shards.
+
+    Args:
+        base_folder(str): The base folder that contains the sub folders.
+        sub_folders(list): The folders to convert, all their images go to the same set of shards.
+        out_folder(str): The folder where the shards are written.
+        label_file_name(str): Name of the label file in each folder.
+        shard_size(int): Approximate size in bytes of each shard.
+    '''
+    writer = None
+    for folder_name in sub_folders:
+        folder_path = os.path.join(base_folder, folder_name)
+        print("Converting %s" % folder_path)
+        with open(os.path.join(folder_path, label_file_name)) as csvfile:
+            for row in csv.reader(csvfile):
+                if writer is None:
+                    writer = ShardWriter(out_folder, shard_size, len(row) - 2)
+                with open(os.path.join(folder_path, row[0]), 'rb') as image_file:
+                    image_bytes = image_file.read()
+                box   = list(map(int, row[1][1:-1].split(',')))
+                votes = list(map(int, row[2:len(row)]))
+                writer.add(image_bytes, box, votes)
+
+    if writer is not None:
+        writer.close()
+        print("Wrote {} records in {} shards.".format(writer.count, writer.shard_count))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d",
+                        "--base_folder",
+                        type = str,
+                        help = "Base folder containing the folders to convert.",
+                        required = True)
+    parser.add_argument("-s",
+                        "--sub_folders",
+                        type = str,
+                        nargs = '+',
+                        default = ['FER2013Train'],
+                        help = "Folders in the FER+ layout to convert.")
+    parser.add_argument("-o",
+                        "--out_folder",
+                        type = str,
+                        help = "Folder where the shards are written.",
+                        required = True)
+    parser.add_argument("--shard_size",
+                        type = int,
+                        default = 64,
+                        help = "Approximate size of each shard in MB.")
+
+    args = parser.parse_args()
+    main(args.base_folder, args.sub_folders, args.out_folder, "label.csv", args.shard_size * 2**20)
@@ -12,10 +12,13 @@ import argparse
 import numpy as np
 import logging
 
-from models import *
-from ferplus import *
+from models import build_model, model_names
+from ferplus import FERPlusParameters, FERPlusReader, HardExampleMiner, display_summary
+from record_shards import ShardReader
+from lazy_import import LazyModule
 
-import cntk as ct
+# CNTK is imported on first use, after the arguments are parsed.
+ct = LazyModule('cntk')
 
 emotion_table = {'neutral'  : 0, 
                  'happiness': 1, 
@@ -26,15 +29,21 @@ emotion_table = {'neutral'  : 0,
                  'fear'     : 6, 
                  'contempt' : 7}
 
+# Minibatch size the learning rates of the models are tuned for.
+reference_minibatch_size = 32
+
 # List of folders for training, validation and test.
 train_folders = ['FER2013Train']
 valid_folders = ['FER2013Valid'] 
 test_folders  = ['FER2013Test']
 
-def cost_func(training_mode, prediction, target):
+def cost_func(training_mode, prediction, target, soft_prediction=None, soft_target=None, soft_weight=0.5, temperature=1.0):
     '''
     We use cross entropy in most mode, except for the multi-label mode, which require treating
     multiple labels exactly the same.
+
+    When distilling, soft_target is the teacher output softened by temperature and soft_prediction the
+    student output softened the same way, as in https://arxiv.org/abs/1503.02531.
     '''
     train_loss = None
     if training_mode == 'majority' or training_mode == 'probability' or training_mode == 'crossentropy': 
@@ -43,9 +52,138 @@ def cost_func(training_mode, prediction, target):
     elif training_mode == 'multi_target':
         train_loss = ct.negate(ct.log(ct.reduce_max(ct.element_times(target, prediction), axis=-1)))
 
+    if soft_target is not None:
+        # the soft loss gradient scales as 1/temperature^2, so we scale it back.
+        soft_loss  = ct.negate(ct.reduce_sum(ct.element_times(soft_target, ct.log(soft_prediction)), axis=-1))
+        train_loss = (1.0 - soft_weight) * train_loss + soft_weight * temperature * temperature * soft_loss
+
     return train_loss
     
-def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs = 100):
+def create_learner(model, lr_per_minibatch):
+    '''
+    Momentum SGD learner of the model parameters. The same learner is shared by the trainers built for every
+    input size so that the momentum carries over, and its learning rate is set at the start of each epoch.
+    '''
+    lr_schedule = ct.learning_rate_schedule(lr_per_minibatch, unit=ct.UnitType.minibatch)
+    mm_schedule = ct.momentum_schedule(0.9)
+    return ct.momentum_sgd(model.model.parameters, lr_schedule, mm_schedule)
+
+def create_trainer(model, size, label_var, training_mode, learner, soft_var=None, soft_weight=0.5, temperature=1.0):
+    '''
+    Build the training graph of the model for the given input size, the parameters are shared with the model
+    at every other size.
+    '''
+    input_var  = ct.input((model.input_channels, size[1], size[0]), np.float32)
+    z          = model.model_for_size(size[0], size[1])(input_var)
+    pred       = ct.softmax(z)
+    soft_pred  = ct.softmax(ct.element_divide(z, temperature)) if soft_var is not None else None
+    train_loss = cost_func(training_mode, pred, label_var, soft_pred, soft_var, soft_weight, temperature)
+    pe         = ct.classification_error(z, label_var)
+
+    trainer = ct.Trainer(z, (train_loss, pe), learner)
+    return input_var, train_loss, trainer
+
+def scaled_learning_rates(base_rate, scale, warmup_epochs):
+    '''
+    Per epoch learning rate of a minibatch: the step schedule of the model scaled linearly with the effective
+    minibatch size, and ramped up linearly from the unscaled rate over the warmup epochs as described in
+    https://arxiv.org/abs/1706.02677. The last rate is used for all the following epochs.
+    '''
+    base_rates = [base_rate]*20 + [base_rate / 2.0]*20 + [base_rate / 10.0]
+    rates      = [rate * scale for rate in base_rates]
+    for epoch in range(min(warmup_epochs, len(rates) - 1)):
+        rates[epoch] = base_rates[epoch] + (rates[epoch] - base_rates[epoch]) * (epoch + 1) / float(warmup_epochs)
+    return rates
+
+def benchmark_minibatch_sizes(model_name, num_classes, training_mode, reader, minibatch_sizes, minibatch_count = 20):
+    '''
+    Log the training throughput for each minibatch size, with the time spent in the reader (decoding and
+    augmentation) and in the trainer reported separately. A fresh model is trained for each size.
+    '''
+    label_var = ct.input((num_classes), np.float32)
+    logging.info("{0}\t{1}\t{2}\t{3}".format("minibatch".ljust(10), "images/s", "train images/s", "read images/s"))
+    for minibatch_size in minibatch_sizes:
+        model = build_model(num_classes, model_name)
+        size  = (model.input_width, model.input_height)
+        learner = create_learner(model, model.learning_rate)
+        input_var, _, trainer = create_trainer(model, size, label_var, training_mode, learner)
+        reader.set_size(size[0], size[1])
+        reader.reset()
+
+        read_time  = 0.0
+        train_time = 0.0
+        count      = 0
+        for step in range(minibatch_count + 1):
+            if not reader.has_more():
+                reader.reset()
+            start_time = time.time()
+            images, labels, current_batch_size = reader.next_minibatch(minibatch_size)
+            read_end   = time.time()
+            trainer.train_minibatch({input_var : images, label_var : labels})
+            train_end  = time.time()
+
+            # the first minibatch includes the graph compilation.
+            if step > 0:
+                read_time  += read_end - start_time
+                train_time += train_end - read_end
+                count      += current_batch_size
+
+        logging.info("{0}\t{1:8.1f}\t{2:8.1f}\t{3:8.1f}".format(str(minibatch_size).ljust(10), 
+                                                                count / (read_time + train_time), 
+                                                                count / train_time, 
+                                                                count / read_time))
+
+def cache_teacher_targets(teacher_path, reader, temperature, minibatch_size):
+    '''
+    Evaluate the teacher model once on every fixed crop of every image of the reader, and return its
+    outputs softened by temperature as an array indexed by sample and crop.
+    '''
+    teacher   = ct.load_model(teacher_path)
+    input_var = teacher.arguments[0]
+    soft      = ct.softmax(ct.element_divide(teacher, temperature))
+
+    # the teacher may expect a different input size than the student.
+    student_size     = (reader.width, reader.height)
+    _, height, width = input_var.shape
+    reader.set_size(width, height)
+
+    targets = np.empty((reader.size(), reader.crop_count, reader.emotion_count), dtype=np.float32)
+    indices = np.arange(reader.size())
+    for crop in range(reader.crop_count):
+        for start in range(0, reader.size(), minibatch_size):
+            batch  = indices[start:start+minibatch_size]
+            images = reader.images(batch, np.full(len(batch), crop))
+            targets[batch, crop] = soft.eval({input_var : images}).reshape(len(batch), -1)
+
+    reader.set_size(student_size[0], student_size[1])
+    return targets
+
+def parse_resolutions(spec):
+    '''
+    Parse a progressive resizing schedule such as "32:10,48:10", each entry is the input size and the number
+    of epochs trained at that size. The epochs after the schedule run at the model native size.
+    '''
+    resolutions = []
+    if spec:
+        for entry in spec.split(','):
+            size, epochs = entry.split(':')
+            resolutions.append((int(size), int(epochs)))
+    return resolutions
+
+def size_at_epoch(resolutions, epoch, native_size):
+    '''
+    Return the (width, height) input size used to train the given epoch.
+    '''
+    for size, epochs in resolutions:
+        if epoch < epochs:
+            return (size, size * native_size[1] // native_size[0])
+        epoch -= epochs
+    return native_size
+
+def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs = 100, hard_mining = False, resolutions = [], 
+         teacher = None, temperature = 4.0, soft_weight = 0.5, distill_crops = 4, seed = None, train_shards = None, 
+         shuffle_buffer = 100000, minibatch_size = reference_minibatch_size, warmup_epochs = 0, 
+         benchmark = None, prune_eval_duplicates = False):
 
     # create needed folders.
     output_model_path   = os.path.join(base_folder, R'models')
@@ -59,6 +197,11 @@ def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs =
 
     logging.info("Starting with training mode {} using {} model and max epochs {}.".format(training_mode, model_name, max_epochs))
 
+    # a fixed seed also makes the weight initialization, the dropout masks and the CNTK kernels deterministic.
+    if seed is not None:
+        ct.cntk_py.set_fixed_random_seed(seed)
+        ct.debugging.force_deterministic_algorithms()
+
     # create the model
     num_classes = len(emotion_table)
     model       = build_model(num_classes, model_name)
@@ -69,36 +212,52 @@ def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs =
     
     # read FER+ dataset.
     logging.info("Loading data...")
-    train_params        = FERPlusParameters(num_classes, model.input_height, model.input_width, training_mode, False)
+    train_params        = FERPlusParameters(num_classes, model.input_height, model.input_width, training_mode, False, seed=seed)
     test_and_val_params = FERPlusParameters(num_classes, model.input_height, model.input_width, "majority", True)
 
-    train_data_reader   = FERPlusReader.create(base_folder, train_folders, "label.csv", train_params)
-    val_data_reader     = FERPlusReader.create(base_folder, valid_folders, "label.csv", test_and_val_params)
-    test_data_reader    = FERPlusReader.create(base_folder, test_folders, "label.csv", test_and_val_params)
+    logging.info("Training data seed {}.".format(train_params.seed))
+    if train_shards:
+        if hard_mining or teacher:
+            raise ValueError("Hard-example mining and distillation need random access to the training set, they can't be used with shards.")
+        train_data_reader = ShardReader.create(train_shards, train_params, shuffle_buffer)
+    else:
+        train_data_reader = FERPlusReader.create(base_folder, train_folders, "label.csv", train_params, "exclude.txt")
+
+    # the evaluation sets stay the FER+ benchmark ones unless their duplicates are explicitly pruned.
+    eval_exclude_file   = "exclude.txt" if prune_eval_duplicates else None
+    val_data_reader     = FERPlusReader.create(base_folder, valid_folders, "label.csv", test_and_val_params, eval_exclude_file)
+    test_data_reader    = FERPlusReader.create(base_folder, test_folders, "label.csv", test_and_val_params, eval_exclude_file)
     
     # print summary of the data.
     display_summary(train_data_reader, val_data_reader, test_data_reader)
+
+    # only measure the throughput of each minibatch size.
+    if benchmark:
+        benchmark_minibatch_sizes(model_name, num_classes, training_mode, train_data_reader, benchmark)
+        return
+
+    # bias the training minibatches toward hard examples.
+    miner = None
+    if hard_mining:
+        miner = HardExampleMiner(train_data_reader)
     
-    # get the probalistic output of the model.
-    z    = model.model(input_var)
-    pred = ct.softmax(z)
+    # get the probalistic output of the model, validation and test always run at the native input size.
+    z         = model.model(input_var)
+    pe        = ct.classification_error(z, label_var)
+    evaluator = ct.Evaluator(pe)
     
-    epoch_size     = train_data_reader.size()
-    minibatch_size = 32
-
     # Training config
-    lr_per_minibatch       = [model.learning_rate]*20 + [model.learning_rate / 2.0]*20 + [model.learning_rate / 10.0]
-    mm_time_constant       = -minibatch_size/np.log(0.9)
-    lr_schedule            = ct.learning_rate_schedule(lr_per_minibatch, unit=ct.UnitType.minibatch, epoch_size=epoch_size)
-    mm_schedule            = ct.momentum_as_time_constant_schedule(mm_time_constant)
+    native_size      = (model.input_width, model.input_height)
+    current_size     = None
+    learner          = create_learner(model, model.learning_rate)
 
-    # loss and error cost
-    train_loss = cost_func(training_mode, pred, label_var)
-    pe         = ct.classification_error(z, label_var)
-
-    # construct the trainer
-    learner = ct.momentum_sgd(z.parameters, lr_schedule, mm_schedule)
-    trainer = ct.Trainer(z, (train_loss, pe), learner)
+    # cache the teacher outputs once per training image and crop, the student then trains on the same crops.
+    soft_var = None
+    if teacher:
+        logging.info("Caching {} teacher outputs per image from {}...".format(distill_crops, teacher))
+        soft_var = ct.input((num_classes), np.float32)
+        train_data_reader.set_fixed_crops(distill_crops)
+        teacher_targets = cache_teacher_targets(teacher, train_data_reader, temperature, minibatch_size)
 
     # Get minibatches of images to train with and perform model training
     max_val_accuracy    = 0.0
@@ -109,7 +268,28 @@ def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs =
     epoch      = 0
     best_epoch = 0
     while epoch < max_epochs: 
+        # switch input size and rebuild the trainer when the progressive schedule moves on, the learner and its
+        # momentum are kept.
+        size = size_at_epoch(resolutions, epoch, native_size)
+        if size != current_size:
+            current_size     = size
+            batch_size       = minibatch_size * (native_size[0] * native_size[1]) // (size[0] * size[1])
+            lr_per_minibatch = scaled_learning_rates(model.learning_rate, batch_size / float(reference_minibatch_size), warmup_epochs)
+            train_data_reader.set_size(size[0], size[1])
+            train_input_var, train_loss, trainer = create_trainer(model, size, label_var, training_mode, learner,
+                                                                  soft_var, soft_weight, temperature)
+            logging.info("Training at {}x{} with minibatch size {}.".format(size[0], size[1], batch_size))
+
+        # the rate is set per epoch rather than by samples seen, epochs don't cover the same number of samples
+        # when hard mining.
+        learning_rate = lr_per_minibatch[min(epoch, len(lr_per_minibatch) - 1)]
+        learner.reset_learning_rate(ct.learning_rate_schedule(learning_rate, unit=ct.UnitType.minibatch))
+        logging.info("Learning rate {}.".format(learning_rate))
+
         train_data_reader.reset()
+        train_data_reader.set_epoch(epoch)
+        if miner:
+            miner.next_epoch(epoch)
         val_data_reader.reset()
         test_data_reader.reset()
         
@@ -117,24 +297,34 @@ def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs =
         start_time = time.time()
         training_loss = 0
         training_accuracy = 0
+        training_size = 0
         while train_data_reader.has_more():
-            images, labels, current_batch_size = train_data_reader.next_minibatch(minibatch_size)
+            images, labels, current_batch_size = train_data_reader.next_minibatch(batch_size)
 
             # Specify the mapping of input variables in the model to actual minibatch data to be trained with
-            trainer.train_minibatch({input_var : images, label_var : labels})
+            arguments = {train_input_var : images, label_var : labels}
+            if soft_var is not None:
+                arguments[soft_var] = teacher_targets[train_data_reader.batch_indices, train_data_reader.batch_crops]
 
-            # keep track of statistics.
+            if miner:
+                _, outputs = trainer.train_minibatch(arguments, outputs=[train_loss.output])
+                miner.update(train_data_reader.batch_indices, outputs[train_loss.output])
+            else:
+                trainer.train_minibatch(arguments)
             training_loss     += trainer.previous_minibatch_loss_average * current_batch_size
             training_accuracy += trainer.previous_minibatch_evaluation_average * current_batch_size
+
+            # keep track of statistics.
+            training_size += current_batch_size
                 
-        training_accuracy /= train_data_reader.size()
+        training_accuracy /= training_size
         training_accuracy = 1.0 - training_accuracy
         
         # Validation
         val_accuracy = 0
         while val_data_reader.has_more():
             images, labels, current_batch_size = val_data_reader.next_minibatch(minibatch_size)
-            val_accuracy += trainer.test_minibatch({input_var : images, label_var : labels}) * current_batch_size
+            val_accuracy += evaluator.test_minibatch({input_var : images, label_var : labels}) * current_batch_size
             
         val_accuracy /= val_data_reader.size()
         val_accuracy = 1.0 - val_accuracy
@@ -145,13 +335,16 @@ def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs =
             best_epoch = epoch
             max_val_accuracy = val_accuracy
 
-            trainer.save_checkpoint(os.path.join(output_model_folder, "model_{}".format(best_epoch)))
+            if current_size == native_size:
+                trainer.save_checkpoint(os.path.join(output_model_folder, "model_{}".format(best_epoch)))
+            else:
+                z.save(os.path.join(output_model_folder, "model_{}".format(best_epoch)))
 
             test_run = True
             test_accuracy = 0
             while test_data_reader.has_more():
                 images, labels, current_batch_size = test_data_reader.next_minibatch(minibatch_size)
-                test_accuracy += trainer.test_minibatch({input_var : images, label_var : labels}) * current_batch_size
+                test_accuracy += evaluator.test_minibatch({input_var : images, label_var : labels}) * current_batch_size
             
             test_accuracy /= test_data_reader.size()
             test_accuracy = 1.0 - test_accuracy
@@ -159,7 +352,7 @@ def main(base_folder, training_mode='majority', model_name='VGG13', max_epochs =
             if final_test_accuracy > best_test_accuracy: 
                 best_test_accuracy = final_test_accuracy
  
-        logging.info("Epoch {}: took {:.3f}s".format(epoch, time.time() - start_time))
+        logging.info("Epoch {}: took {:.3f}s, {} training samples".format(epoch, time.time() - start_time, training_size))
         logging.info("  training loss:\t{:e}".format(training_loss))
         logging.info("  training accuracy:\t\t{:.2f} %".format(training_accuracy * 100))
         logging.info("  validation accuracy:\t\t{:.2f} %".format(val_accuracy * 100))
@@ -185,6 +378,70 @@ if __name__ == "__main__":
                         type = str,
                         default='majority',
                         help = "Specify the training mode: majority, probability, crossentropy or multi_target.")
+    parser.add_argument("-n", 
+                        "--model_name", 
+                        type = str,
+                        default='VGG13',
+                        help = "Specify the model: {}.".format(", ".join(model_names())))
+    parser.add_argument("--hard_mining",
+                        action = "store_true",
+                        help = "Bias each epoch toward high-loss and ambiguous samples instead of visiting all of them.")
+
+    parser.add_argument("--resolutions",
+                        type = str,
+                        default = "",
+                        help = "Progressive resizing schedule, e.g. \"32:10,48:10\" trains 10 epochs at 32x32 then 10 at 48x48 "
+                               "with proportionally larger minibatches before switching to the model native size.")
+
+    parser.add_argument("--teacher",
+                        type = str,
+                        help = "Path of a trained model to distill from, its softened outputs become additional targets.")
+    parser.add_argument("--temperature",
+                        type = float,
+                        default = 4.0,
+                        help = "Softmax temperature applied to both teacher and student outputs when distilling.")
+    parser.add_argument("--soft_weight",
+                        type = float,
+                        default = 0.5,
+                        help = "Weight of the distillation loss, the FER+ targets get the rest.")
+    parser.add_argument("--distill_crops",
+                        type = int,
+                        default = 4,
+                        help = "Number of fixed crops per training image for which the teacher output is cached.")
+
+    parser.add_argument("--seed",
+                        type = int,
+                        help = "Seed of the weight initialization, dropout, data augmentation and sampling, runs with the same seed are identical.")
+
+    parser.add_argument("--train_shards",
+                        type = str,
+                        help = "Folder of shards written by record_shards.py to train on instead of FER2013Train.")
+    parser.add_argument("--shuffle_buffer",
+                        type = int,
+                        default = 100000,
+                        help = "Number of samples held in memory to shuffle the shards.")
+    parser.add_argument("--prune_eval_duplicates",
+                        action = "store_true",
+                        help = "Also skip the validation and test images listed in exclude.txt, which changes the benchmark sets.")
+
+    parser.add_argument("-b",
+                        "--minibatch_size",
+                        type = int,
+                        default = reference_minibatch_size,
+                        help = "Minibatch size, the learning rate is scaled linearly from a minibatch of {}.".format(reference_minibatch_size))
+    parser.add_argument("--warmup_epochs",
+                        type = int,
+                        default = 0,
+                        help = "Number of epochs over which the learning rate ramps up to its scaled value.")
+    parser.add_argument("--benchmark",
+                        type = str,
+                        help = "Comma separated minibatch sizes, only report the training throughput of each one.")
 
     args = parser.parse_args()
-    main(args.base_folder, args.training_mode)
\ No newline at end of file
+    main(args.base_folder, args.training_mode, args.model_name, hard_mining=args.hard_mining, 
+         resolutions=parse_resolutions(args.resolutions), teacher=args.teacher, temperature=args.temperature, 
+         soft_weight=args.soft_weight, distill_crops=args.distill_crops, seed=args.seed, 
+         train_shards=args.train_shards, shuffle_buffer=args.shuffle_buffer, minibatch_size=args.minibatch_size, 
+         warmup_epochs=args.warmup_epochs, 
+         benchmark=[int(size) for size in args.benchmark.split(',')] if args.benchmark else None, 
+         prune_eval_duplicates=args.prune_eval_duplicates)
\ No newline at end of file
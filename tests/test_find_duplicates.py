@@ -0,0 +1,27 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+from find_duplicates import find_near_duplicates, select_excluded
+
+def test_train_duplicate_of_excluded_test_image_is_excluded():
+    # X duplicates X0 within the test set, and the training image T duplicates X: T must be excluded even
+    # though X is itself marked, since the test set is not pruned by default.
+    images = [('FER2013Test', 'X0.png'), ('FER2013Test', 'X.png'), ('FER2013Train', 'T.png')]
+    pairs  = find_near_duplicates([0b0, 0b111, 0b111111], 3)
+
+    assert pairs == [(0, 1, 3), (1, 2, 3)]
+    assert select_excluded(images, pairs) == {1, 2}
+
+def test_exclusions_chain_within_a_folder():
+    # A ~ B and B ~ C within the training set: B is dropped, so C is kept as it only matches B.
+    images = [('FER2013Train', 'A.png'), ('FER2013Train', 'B.png'), ('FER2013Train', 'C.png')]
+    pairs  = [(0, 1, 2), (1, 2, 2)]
+
+    assert select_excluded(images, pairs) == {1}
@@ -0,0 +1,28 @@
+#
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+#
+
+import os
+import sys
+import time
+import subprocess
+
+src_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+
+# Heavy modules that must only be imported when actually used.
+lazy_modules = ['cntk', 'scipy', 'matplotlib']
+
+# Bound on the wall time of importing the training and data modules in a fresh interpreter, it takes about
+# 0.2s today while importing CNTK alone takes several seconds.
+max_import_seconds = 1.5
+
+def test_import_is_lazy_and_fast():
+    code = "import sys, ferplus, img_util, models, model_profiler, train; " \
+           "print(','.join(name for name in {} if name in sys.modules))".format(lazy_modules)
+    start_time = time.time()
+    output     = subprocess.check_output([sys.executable, '-c', code], cwd=src_folder)
+    elapsed    = time.time() - start_time
+
+    assert output.decode().strip() == '', "Imported at startup: {}".format(output.decode().strip())
+    assert elapsed < max_import_seconds, "Importing took {:.2f}s".format(elapsed)